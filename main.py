@@ -1,14 +1,72 @@
 import os
+import functools
 import traceback
+from datetime import date
+from typing import Any
+import orjson
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field, FiniteFloat, ValidationError, model_validator
 import numpy as np
 import pandas as pd
 
 from starline_optimizer import OptimizationEngine, TradeResult, logger
+from starline_optimizer.engine import DEFAULT_PLANNING_HORIZON, MAX_PLANNING_HORIZON
 
 TRADE_PERIODS = 252
+ENGINE_CACHE_SIZE = 64
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson.
+    Floats and numpy values are serialized in C instead of through the stdlib json encoder.
+    Values orjson can't serialize, like timestamps, fall back to Flask's default conversions.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+
+class OptimizeRequest(BaseModel):
+    """Request body for optimize(). See optimize() for parameter descriptions."""
+
+    tickers: list[str] = Field(min_length=1)
+    # NaN and infinity would otherwise pass validation and fail inside the optimizer
+    starting_portfolio: list[FiniteFloat] | None = None
+    returns_target: FiniteFloat | None = None
+    risk_threshold: FiniteFloat | None = Field(default=None, gt=0)
+    planning_horizon: int = Field(default=DEFAULT_PLANNING_HORIZON, ge=1, le=MAX_PLANNING_HORIZON)
+
+    @model_validator(mode="after")
+    def _check_portfolio_length(self) -> "OptimizeRequest":
+        if self.starting_portfolio is not None and \
+                len(self.starting_portfolio) != len(self.tickers) + 1:
+            raise ValueError("Parameter 'starting_portfolio' must have one more element than "
+                             "'tickers'.")
+        return self
+
+
+@functools.lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def _engine_for(tickers: tuple[str, ...], as_of: date) -> OptimizationEngine:
+    """Gets an optimization engine over the tickers, reusing engines built by earlier requests.
+
+    :param tickers: Tickers to optimize a portfolio over, in request order
+                    Order is kept since portfolio values are matched to tickers by position
+    :param as_of: Date the engine's data is current for
+                  A new day's requests build a new engine with refreshed data
+
+    :return: Optimization engine for the tickers
+    """
+    return OptimizationEngine(list(tickers))
 
 
 @app.route("/", methods=["POST"])
@@ -25,42 +83,52 @@ def optimize():
                                Defaults to $1M cash with no assets
     :param returns_target: Annualized returns value to target
     :param risk_threshold: Annualized risk level to stay under
+    :param planning_horizon: Number of trading days the optimizer plans over
+                             Defaults to 6, at most 20, lower values respond faster
 
     :return: 70 potential portfolios
     """
-    def trade_to_json(trade: TradeResult, starting_h: pd.Series, op: OptimizationEngine):
-        tickers = op.data.tickers
+    def trade_to_json(trade: TradeResult, annualized_return: float, annualized_risk: float,
+                      op: OptimizationEngine, tickers_with_cash: pd.Index):
         u, t, shares_traded = trade
         return {
-                "trade": dict(zip(tickers + ["USDOLLAR"], u.to_list())),
+                "trade": dict(zip(tickers_with_cash, u.to_numpy())),
                 "exec_time": t,
-                "shares_traded": dict(zip(tickers, shares_traded.to_list())),
-                "annualized_return": op.h_return(starting_h + u) ** TRADE_PERIODS,
-                "annualized_risk": op.h_risk((starting_h + u).iloc[:-1]) * TRADE_PERIODS
+                "shares_traded": dict(zip(op.data.tickers, shares_traded.to_numpy())),
+                "annualized_return": annualized_return,
+                "annualized_risk": annualized_risk
                 }
 
     # Check request body params
     try:
-        body = request.get_json()
-        logger.info(f"{request.host} received request from {request.origin}:\n{body}")
-        tickers = body["tickers"]
-    except KeyError:
-        reason = "{request.host} failed: Request parameter 'ticker' required but not found."
+        body = OptimizeRequest.model_validate_json(request.get_data())
+        # Formatted by loguru only if the message is emitted
+        logger.info("{} received request from {}:\n{}", request.host, request.origin, body)
+    except ValidationError as e:
+        reason = f"{request.host} failed: Invalid request body.\n{e}"
         logger.warning(reason)
         return jsonify({"error": reason}), 400
 
     # Exec optimizer
     try:
-        op = OptimizationEngine(tickers)
-
-        starting_h = pd.Series(body.get("starting_portfolio", op._cash_only()))
-        starting_h.index = np.append(op.data.tickers, "USDOLLAR")
+        op = _engine_for(tuple(body.tickers), date.today())
+        tickers_with_cash = op.data.tickers_with_cash
 
-        r_target = body.get("returns_target", None)
-        sig_thresh = body.get("risk_threshold", None)
+        if body.starting_portfolio is None:
+            starting_h = op._cash_only()
+        else:
+            starting_h = pd.Series(body.starting_portfolio, index=tickers_with_cash,
+                                   dtype=np.float64)
 
-        trades = op.execute(starting_h, r_target=r_target, sig_thresh=sig_thresh)
-        return jsonify(list(map(lambda t: trade_to_json(t, starting_h, op), trades)))
+        trades = op.execute(starting_h, r_target=body.returns_target,
+                            sig_thresh=body.risk_threshold,
+                            planning_horizon=body.planning_horizon)
+        # Score all post-trade portfolios together, one per row
+        H = starting_h.to_numpy() + np.stack([u.to_numpy() for u, _, _ in trades])
+        returns = op.h_return_batch(H) ** TRADE_PERIODS
+        risks = op.h_risk_batch(H[:, :-1]) * TRADE_PERIODS
+        return jsonify(list(map(lambda t, r, s: trade_to_json(t, r, s, op, tickers_with_cash),
+                                trades, returns, risks)))
     except Exception as e:
         logger.error(f"{request.host} failed:\n{traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
@@ -68,4 +136,6 @@ def optimize():
 
 if __name__ == "__main__":
     load_dotenv()
-    app.run(port=int(os.environ.get("PORT", 8080)), debug=True)
+    # The debug reloader runs a second copy of the app, so keep it out of production
+    app.run(port=int(os.environ.get("PORT", 8080)),
+            debug=os.environ.get("APP_ENV") != "production")
@@ -1,8 +1,12 @@
+import re
 import pandas as pd
 
 from .env import DATABASES, client, OLDEST_ENTRY_DATE
 from .logger import logger
 
+# Table and database names are formatted into SQL, so they may only contain word characters
+_IDENTIFIER = re.compile(r"\w+")
+
 
 def coerce_uppercase_tablename(table: str) -> str:
     """
@@ -10,6 +14,7 @@ def coerce_uppercase_tablename(table: str) -> str:
     "[database].[table]" or "[table]",
     replaces spaces with underscores, and
     coerces and returns the table portion to uppercase.
+    Raises ValueError for names that aren't plain identifiers.
     ex. series.aapl becomes series.AAPL
         "spy us equity" becomes SPY_US_EQUITY
 
@@ -21,7 +26,7 @@ def coerce_uppercase_tablename(table: str) -> str:
     *database, table = table.split(".")
     table = table.upper()
 
-    if len(database) > 1:
+    if len(database) > 1 or not all(map(_IDENTIFIER.fullmatch, [*database, table])):
         raise ValueError(f"Table name {table} is invalid.")
 
     if database == []:
@@ -43,24 +48,25 @@ def list_tables(database: str = None) -> list[str]:
         assert database in DATABASES
         # Each row is info about one table
         # The first entry in each is the table database, second is the table name
-        tables_unformatted = client.command(
-            f"""
+        rows = client.query(
+            """
                     SELECT table_schema, table_name FROM information_schema.tables
-                    WHERE table_schema = '{database}'
-                    """
-        )
-        return ".".join(tables_unformatted).split("\n")
+                    WHERE table_schema = {database:String}
+                    """,
+            parameters={"database": database},
+        ).result_rows
+        return list(map(lambda r: f"{r[0]}.{r[1]}", rows))
 
     if database is None:
-        tables_unformatted = client.command(
+        rows = client.query(
             """
                     SELECT table_schema, table_name FROM information_schema.tables
                     WHERE table_schema != 'INFORMATION_SCHEMA' AND
                     table_schema != 'information_schema' AND
                     table_schema != 'system'
                     """
-        )
-        return ".".join(tables_unformatted).split("\n")
+        ).result_rows
+        return list(map(lambda r: f"{r[0]}.{r[1]}", rows))
 
 
 def table_columns(table: str) -> list[str]:
@@ -71,11 +77,44 @@ def table_columns(table: str) -> list[str]:
 
     :return: Table column names
     """
-    tablecols = " ".join(client.command(f"DESCRIBE TABLE {table}")).split("\n")
-    return list(map(lambda c: c.strip(), tablecols))
+    table = coerce_uppercase_tablename(table)
+    # The first entry of each DESCRIBE row is the column name
+    return list(map(lambda r: r[0], client.query(f"DESCRIBE TABLE {table}").result_rows))
+
+
+def _timespan_query(table: str, start: pd.Timestamp = None,
+                    end: pd.Timestamp = None) -> tuple[str, dict]:
+    """
+    Builds the query selecting all time series entries of a table within a certain timespan
+    Start and end date inclusive
+    Dates are bound server side as query parameters rather than formatted into the SQL
+    Reads with FINAL so entries upserted for the same date are returned once
 
+    :param table: Uppercased table name
+
+    Optional
+    :param start: First date to get data for
+    :param end: Last date to get data for
 
-def get_timespan(table: str, start: pd.Timestamp = None, end: pd.Timestamp = None) -> list[tuple]:
+    :return: SELECT query for the timespan and its query parameters
+    """
+    # Timestamps are sent as text since the driver can't shift tz-naive pd.Timestamps
+    parameters = {}
+    conditions = []
+    if start is not None:
+        parameters["start"] = str(start)
+        conditions.append("date >= {start:DateTime64(3)}")
+    if end is not None:
+        parameters["end"] = str(end)
+        conditions.append("date <= {end:DateTime64(3)}")
+
+    if conditions == []:
+        return f"SELECT * FROM {table} FINAL", parameters
+    return f"SELECT * FROM {table} FINAL WHERE {' AND '.join(conditions)}", parameters
+
+
+def get_timespan(table: str, start: pd.Timestamp = None,
+                 end: pd.Timestamp = None) -> pd.DataFrame:
     """
     Gets all time series entries within a certain timespan
     Start and end date inclusive
@@ -88,26 +127,56 @@ def get_timespan(table: str, start: pd.Timestamp = None, end: pd.Timestamp = Non
     :param end: Last date to get data for
                 Defaults to most recent date in the table
 
-    :return: All matching timeseries entries
+    :return: All matching timeseries entries, indexed by date
     """
     table = coerce_uppercase_tablename(table)
 
-    if start is None and end is None:
-        data = client.command(f"SELECT * FROM {table}")
-    elif end is None:
-        data = client.command(f"SELECT * FROM {table} WHERE date >= '{start}'")
-    elif start is None:
-        data = client.command(f"SELECT * FROM {table} WHERE date <= '{end}'")
-    else:
-        data = client.command(f"SELECT * FROM {table} WHERE date >= '{start}' AND date <= '{end}'")
-
-    # List strings are tab-separated; make them newline-separated
-    # and convert each resulting row into a tuple
-    res = list(map(lambda r: tuple(r.split(", ")), ", ".join(data).split("\n")))
+    # Columns are read from the wire straight into typed numpy arrays
+    query, parameters = _timespan_query(table, start, end)
+    res = client.query_df(query, parameters=parameters).set_index("date")
     logger.debug(f"Fetched {len(res)} entries from {table}.")
     return res
 
 
+def get_timespan_multi(tables: list[str], start: pd.Timestamp = None,
+                       end: pd.Timestamp = None) -> pd.DataFrame:
+    """
+    Gets all time series entries within a certain timespan for several tables in one query
+    Start and end date inclusive
+    All tables must share the same columns
+
+    :param tables: The tables to get time series data from
+
+    Optional
+    :param start: First date to get data for
+                  Defaults to earliest date in each table
+    :param end: Last date to get data for
+                Defaults to most recent date in each table
+
+    :return: All matching timeseries entries of every table indexed by date,
+             with a categorical "table" column holding each entry's table name as given
+    """
+    tables = list(dict.fromkeys(tables))  # Query each table once
+    parameters = {}
+    subqueries = []
+    for t in tables:
+        subquery, parameters = _timespan_query(coerce_uppercase_tablename(t), start, end)
+        subqueries.append(subquery)
+    # Each row is tagged with the position of its table so results can be split back up
+    union = " UNION ALL ".join(
+        f"SELECT toUInt32({i}) AS table_pos, * FROM ({subquery})"
+        for i, subquery in enumerate(subqueries)
+    )
+    # Entries of each table come back in date order
+    query = f"SELECT * FROM ({union}) ORDER BY table_pos, date"
+
+    res = client.query_df(query, parameters=parameters).set_index("date")
+    # The positions are already the codes of a categorical over the table names
+    res["table"] = pd.Categorical.from_codes(res.pop("table_pos"), categories=tables)
+    logger.debug(f"Fetched {len(res)} entries from {len(tables)} tables.")
+    return res
+
+
 def upsert_entries(table: str, rows: list[tuple] | pd.DataFrame, *, ch_client=None):
     """
     Inserts or updates entries in the table
@@ -137,11 +206,28 @@ def upsert_entries(table: str, rows: list[tuple] | pd.DataFrame, *, ch_client=No
         rows = list(filter(lambda r: r[0] >= OLDEST_ENTRY_DATE, rows))
         ch_client.command(f"INSERT INTO {table} (*) VALUES", rows)
 
-    # Deletes duplicate values
-    ch_client.command(f"OPTIMIZE TABLE {table}")
+    # Duplicate dates are merged away in the background, reads use FINAL until then
     logger.info(f"Data upsert for {table} succeeded.")
 
 
+def optimize_table(table: str, *, ch_client=None):
+    """
+    Merges the table's parts, deleting duplicate entries
+    Reads already skip duplicates, so this is only needed to reclaim space
+    Run once after a batch of upserts rather than after each one
+
+    :param table: The table name to optimize, case insensitive
+
+    Optional
+    :param ch_client: Alternate Clickhouse client to use
+    """
+    if ch_client is None:
+        ch_client = client
+
+    table = coerce_uppercase_tablename(table)
+    ch_client.command(f"OPTIMIZE TABLE {table} FINAL")
+
+
 def get_recent_entry(table: str) -> pd.Timestamp:
     """Gets the most recent entry for a table.
     If the table has no entries, defaults to the earliest date possible
@@ -150,4 +236,5 @@ def get_recent_entry(table: str) -> pd.Timestamp:
 
     :return: Timestamp of the most recent entry
     """
+    table = coerce_uppercase_tablename(table)
     return pd.Timestamp(client.command(f"SELECT max(date) FROM {table}"))
@@ -3,9 +3,10 @@
 import json
 import yfinance as yf
 import numpy as np
+import pandas as pd
 from .logger import logger
 from .env import client
-from .clickhouse import coerce_uppercase_tablename, get_recent_entry, upsert_entries
+from .clickhouse import coerce_uppercase_tablename, get_recent_entry, optimize_table, upsert_entries
 
 
 def create_series_table(ticker: str):
@@ -40,22 +41,47 @@ def update_timeseries(table: str):
 
     :param table: The table to update
     """
-    table = coerce_uppercase_tablename(table)
-    _, ticker = table.split(".")
-    create_series_table(ticker)  # If the table doesn't exist beforehand
-    start_date = get_recent_entry(table)
-    logger.info(f"Fetching data for {ticker} starting from {start_date.date()}.")
-
-    dataraw = yf.Tickers(ticker).download(start=start_date)
-    if dataraw is None:
-        reason = f"Failed to download yfinance data for ticker {ticker}"
-        logger.error(json.dumps(reason))
-        raise RuntimeError(reason)
-
-    # DataFrame manip to get dataframes with date, price, volume columns for each ticker
-    data = dataraw.swaplevel(axis=1)[ticker][["Close", "Volume"]]
-    data.reset_index(inplace=True)
-    data.columns = ["date", "price", "volume"]
-    data.ffill(inplace=True)  # Fill None values
-    data["volume"] = np.uint32(data["volume"])  # Coerce volume from int to unsigned int
-    upsert_entries(table, data)
+    update_timeseries_multi([table])
+
+
+def update_timeseries_multi(tables: list[str]):
+    """Adds additional entries into the database for each table if not all entries are up to date.
+    Uses one yfinance download for all tables whose data starts from the same date.
+
+    :param tables: The tables to update
+    """
+    tables = list(dict.fromkeys(map(coerce_uppercase_tablename, tables)))
+
+    # Tables grouped by the date their new data starts from, so a new or stale table
+    # doesn't drag every other ticker's download back to its own start date
+    tables_by_start: dict[pd.Timestamp, list[str]] = {}
+    for table in tables:
+        create_series_table(table.split(".")[1])  # If the table doesn't exist beforehand
+        tables_by_start.setdefault(get_recent_entry(table), []).append(table)
+
+    for start_date, group in tables_by_start.items():
+        tickers = list(map(lambda t: t.split(".")[1], group))
+        logger.info(f"Fetching data for {tickers} starting from {start_date.date()}.")
+
+        dataraw = yf.download(tickers, start=start_date, group_by="ticker", threads=True)
+        if dataraw is None:
+            reason = f"Failed to download yfinance data for tickers {tickers}"
+            logger.error(json.dumps(reason))
+            raise RuntimeError(reason)
+
+        for table, ticker in zip(group, tickers):
+            # DataFrame manip to get dataframes with date, price, volume columns for each ticker
+            data = dataraw[ticker][["Close", "Volume"]]
+            data = data[data.index >= start_date]
+            data = data.ffill().dropna()  # Fill None values, drop dates before the ticker's first
+            # Columns are cast once as whole arrays, volume from float to unsigned int
+            data = pd.DataFrame({
+                "date": data.index,
+                "price": data["Close"].to_numpy(dtype=np.float64),
+                "volume": data["Volume"].to_numpy(dtype=np.uint32),
+            })
+            upsert_entries(table, data)
+
+    # Compact each table once for the whole batch, not after every upsert
+    for table in tables:
+        optimize_table(table)
@@ -1,35 +1,42 @@
 import time
 import json
+import struct
+import hashlib
+import numpy as np
 import pandas as pd
 import cvxportfolio as cvx
 from typing import Callable
 
 from .env import APP_ENV
 from .logger import logger
-from .clickhouse import get_timespan
-from .clickhouse_timeseries import update_timeseries
+from .clickhouse import get_timespan_multi
+from .clickhouse_timeseries import update_timeseries_multi
 
 # TODO Returns forecast dataframe from Clickhouse
 
 # past_returns, current_returns, past_volumes, current_volumes, current_prices
 type DataInstance = tuple[pd.DataFrame, pd.Series, pd.DataFrame, pd.Series, pd.Series]
 
+# Net per-period return of cash, as cvxportfolio expects for USDOLLAR, with 252 periods per year
+CASH_RETURN = 1.04 ** (1 / 252) - 1  # TODO temp 4% annual risk-free rate
 
-def _tuples_to_df(data: list[tuple[pd.Timestamp, float, int]]) -> pd.DataFrame:
+
+def _returns(prices: pd.DataFrame) -> pd.DataFrame:
     """
-    Converts a list of tuples that represent rows in the "series" database into a DataFrame
+    Computes period-over-period returns from forward-filled prices in a single numpy pass
+    Returns that can't be computed, like the first period's and those before an asset's
+    first price, are 0
 
-    :param data: List of database rows:
-                 the first element is the timestamp
-                 the second element is the price
-                 the third element is the volume
+    :param prices: Forward-filled prices with timestamp index and a column for each asset
 
-    :return: A dataframe with timestamp index and price and volume columns
+    :return: A dataframe of returns with the same index and columns as prices
     """
-    date, price, volume = zip(*data)
-    date = pd.to_datetime(date)
-    df = pd.DataFrame({"price": price, "volume": volume}, index=date)
-    return df
+    px = prices.to_numpy(dtype=np.float64)
+    ret = np.zeros_like(px)
+    np.divide(px[1:], px[:-1], out=ret[1:])
+    ret[1:] -= 1
+    ret[np.isnan(ret)] = 0
+    return pd.DataFrame(ret, index=prices.index, columns=prices.columns)
 
 
 class DataProvider(cvx.data.MarketData):
@@ -37,9 +44,14 @@ class DataProvider(cvx.data.MarketData):
 
     __id: str  # Used to identify different DataProviders within logs
     tickers: list[str]
+    tickers_with_cash: pd.Index  # Tickers followed by USDOLLAR, built once
     __prices: pd.DataFrame
-    __return: pd.DataFrame
-    __volume: pd.DataFrame
+    __price_values: np.ndarray
+    __index_i8: np.ndarray  # __prices timestamps as int64 nanoseconds, for binary search
+    __return_values: np.ndarray  # Asset and cash returns as one C-contiguous float64 block
+    __return_columns: pd.Index
+    __return_cumsum: np.ndarray  # Running sums of __return_values rows, for O(1) mean returns
+    __volume_values: np.ndarray
 
     def __init__(self, tickers: list[str]):
         """Initializes DataProvider with price and volume data.
@@ -47,25 +59,35 @@ class DataProvider(cvx.data.MarketData):
 
         :param tickers: List of tickers for this DataProvider instance
         """
-        for t in tickers:
-            update_timeseries(f"series.{t}")
-        data = list(map(lambda t: _tuples_to_df(get_timespan(f"series.{t}")), tickers))
-        prices = map(lambda d, a: d[["price"]].rename({"price": a}, axis=1), data, tickers)
-        volumes = map(lambda d, a: d[["volume"]].rename({"volume": a}, axis=1), data, tickers)
-
-        prices_df = pd.concat(prices, axis=1)
-        volumes_df = pd.concat(volumes, axis=1)
+        tables = list(map(lambda t: f"series.{t}", tickers))
+        # One yfinance download updates every ticker's timeseries
+        update_timeseries_multi(tables)
+        # Fetch every ticker in one Clickhouse round trip, then pivot to a column per ticker
+        series = get_timespan_multi(tables).set_index("table", append=True)
+        prices_df = series["price"].unstack("table").reindex(columns=tables)
+        # Dates missing for a ticker have 0 volume, filled while pivoting
+        # so volumes keep the integer type Clickhouse returns them in
+        volumes_df = series["volume"].unstack("table", fill_value=0) \
+            .reindex(columns=tables, fill_value=np.uint32(0))
+        prices_df.columns = volumes_df.columns = pd.Index(tickers)
 
-        # All database entries are type str, convert to actual useful values
         # If any price entry is missing from the dataframe use the previous date's entry
-        prices_df = prices_df.ffill().map(float)
-        volumes_df = volumes_df.fillna(0).map(int)
+        prices_df = prices_df.ffill()
 
         self.tickers = tickers
         self.__prices = prices_df
-        self.__return = prices_df.pct_change().fillna(0)
-        self.__return["USDOLLAR"] = 0.04**252  # TODO temp risk-free rate value
-        self.__volume = volumes_df  # TODO macro values have no volume
+        self.__price_values = prices_df.to_numpy()
+        self.__index_i8 = prices_df.index.asi8
+        if not prices_df.index.is_monotonic_increasing:  # Binary searches rely on sorted times
+            raise pd.errors.DataError(f"Price data for {tickers} isn't sorted by time.")
+        returns = _returns(prices_df)
+        # Cash returns are stored alongside asset returns so served slices are views of one array
+        cash_returns = np.full(len(returns), CASH_RETURN)
+        self.__return_values = np.column_stack([returns.to_numpy(), cash_returns])
+        self.__return_columns = returns.columns.append(pd.Index(["USDOLLAR"]))
+        self.tickers_with_cash = self.__return_columns
+        self.__return_cumsum = np.cumsum(self.__return_values, axis=0)
+        self.__volume_values = volumes_df.to_numpy()  # TODO macro values have no volume
         self._genid()
         self._log(logger.info, f"Successfully initalized {self.__id} with tickers {self.tickers}")
 
@@ -80,46 +102,91 @@ class DataProvider(cvx.data.MarketData):
         if addtl_fields is None:
             addtl_fields = {}
 
-        if APP_ENV == "production":
-            severity(json.dumps({
-                "class_instance": self.__id,
-                "tickers": self.tickers,
-                "message": message,
-                **addtl_fields
-                }))
-        else:
+        def render() -> str:
+            if APP_ENV == "production":
+                return json.dumps({
+                    "class_instance": self.__id,
+                    "tickers": self.tickers,
+                    "message": message,
+                    **addtl_fields
+                    })
             if addtl_fields == {}:
-                severity(message)
-            else:
-                severity(f"{message}\n{json.dumps(addtl_fields, indent=4)}")
+                return message
+            return f"{message}\n{json.dumps(addtl_fields, indent=4)}"
+
+        # Rendered only if the severity is enabled, since trace logs are on hot paths
+        getattr(logger.opt(lazy=True), severity.__name__)("{}", render)
 
     def _genid(self):
-        """Generates an 8-digit hash for the __id field of this DataProvider. """
-        hashstr = str(self.tickers) + str(time.time())
-        self.__id = "DataProvider" + str(abs(hash(hashstr)) % (10 ** 8))
+        """Generates an 8-digit hex hash for the __id field of this DataProvider.
+        Unlike hash(), blake2b doesn't depend on the interpreter's hash seed.
+        """
+        digest = hashlib.blake2b(",".join(self.tickers).encode(), digest_size=4)
+        digest.update(struct.pack("<d", time.time()))
+        self.__id = "DataProvider" + digest.hexdigest()
 
-    def serve(self, t: pd.Timestamp) -> DataInstance:
-        """Serve data for policy and simulator at time t.
+    def _date_pos(self, t: pd.Timestamp) -> int:
+        """Finds the position of a trading time with a binary search over the int64 timestamps.
 
         :param t: Trading time. It must be included in the timestamps returned
                   by self.trading_calendar.
 
-        :return: past_returns, current_returns, past_volumes, current_volumes, current_prices
+        :return: Position of t in the trading calendar
         """
-        date_pos = self.__prices.index.get_loc(t)
+        t_i8 = pd.Timestamp(t).value
+        date_pos = int(np.searchsorted(self.__index_i8, t_i8))
 
-        if not isinstance(date_pos, int):
+        if date_pos == len(self.__index_i8) or self.__index_i8[date_pos] != t_i8:
+            raise KeyError(t)
+        if date_pos + 1 < len(self.__index_i8) and self.__index_i8[date_pos + 1] == t_i8:
+            self._log(logger.error, f"Price data for {self.__id} has duplicate timestamps.")
             raise pd.errors.DataError(f"Price data for DataProvider has duplicate timestamps {t}.")
+        return date_pos
+
+    def serve(self, t: pd.Timestamp) -> DataInstance:
+        """Serve data for policy and simulator at time t.
+
+        :param t: Trading time. It must be included in the timestamps returned
+                  by self.trading_calendar.
 
-        past_returns = self.__return.iloc[: date_pos - 1]
-        curr_returns = self.__return.iloc[date_pos]
-        past_volumes = self.__volume.iloc[: date_pos - 1]
-        curr_volumes = self.__volume.iloc[date_pos]
-        curr_prices = self.__prices.iloc[date_pos]
+        :return: past_returns, current_returns, past_volumes, current_volumes, current_prices
+        """
+        date_pos = self._date_pos(t)
+
+        # Built over views of the stored arrays, so nothing is copied
+        # Past data is every period before t, as in cvxportfolio's own MarketData
+        index, tickers = self.__prices.index, self.__prices.columns
+        past_returns = pd.DataFrame(self.__return_values[:date_pos], index=index[:date_pos],
+                                    columns=self.__return_columns, copy=False)
+        curr_returns = pd.Series(self.__return_values[date_pos], index=self.__return_columns,
+                                 name=index[date_pos], copy=False)
+        past_volumes = pd.DataFrame(self.__volume_values[:date_pos], index=index[:date_pos],
+                                    columns=tickers, copy=False)
+        curr_volumes = pd.Series(self.__volume_values[date_pos], index=tickers,
+                                 name=index[date_pos], copy=False)
+        curr_prices = pd.Series(self.__price_values[date_pos], index=tickers,
+                                name=index[date_pos], copy=False)
 
         self._log(logger.trace, f"{self.__id} Served data for time {t}")
         return (past_returns, curr_returns, past_volumes, curr_volumes, curr_prices)
 
+    def returns_mean_up_to(self, t: pd.Timestamp) -> pd.Series:
+        """Mean of the past returns served at time t, without slicing them.
+        Taken from running sums over the returns, so the cost doesn't grow with history length.
+
+        :param t: Trading time. It must be included in the timestamps returned
+                  by self.trading_calendar.
+
+        :return: Mean past return of each asset and cash
+        """
+        date_pos = self._date_pos(t)
+
+        past_periods = date_pos  # Same rows as past_returns in self.serve()
+        if past_periods < 1:
+            return pd.Series(np.nan, index=self.__return_columns)
+        mean = self.__return_cumsum[past_periods - 1] / past_periods
+        return pd.Series(mean, index=self.__return_columns)
+
     def trading_calendar(
         self,
         start_time: None | pd.Timestamp = None,
@@ -137,19 +204,17 @@ class DataProvider(cvx.data.MarketData):
         :return: Trading calendar.
         """
         calendar = self.__prices.index
-        start_date_pos = 0 if start_time is None else calendar.get_loc(start_time)
-
-        if end_time is not None:
-            end_date_pos = calendar.get_loc(end_time)
-            if not isinstance(end_date_pos, int):
-                self._log(logger.error, f"Price data for {self.__id} has duplicate timestamps.")
-                raise pd.errors.DataError("Price data for DataProvider has duplicate timestamps.")
-            if not include_end:
-                end_date_pos -= 1
-        else:
-            end_date_pos = None
-
-        return calendar[start_date_pos:end_date_pos]
+        if start_time is None and end_time is None:
+            return calendar  # Same index object on every call, no slicing needed
+
+        # Bounds are binary searched, so they don't need to be trading times themselves
+        start_pos = None if start_time is None else \
+            np.searchsorted(self.__index_i8, pd.Timestamp(start_time).value, side="left")
+        end_pos = None if end_time is None else \
+            np.searchsorted(self.__index_i8, pd.Timestamp(end_time).value,
+                            side="right" if include_end else "left")
+
+        return calendar[start_pos:end_pos]
 
     @property
     def periods_per_year(self) -> int:
@@ -1,5 +1,9 @@
 import time
 import json
+import struct
+import hashlib
+import functools
+import threading
 import numpy as np
 import pandas as pd
 import cvxportfolio as cvx
@@ -9,6 +13,7 @@ from .env import APP_ENV
 from .logger import logger
 from .data_provider import DataProvider
 from .threshold_constraints import ReturnsTarget, RiskThreshold
+from .gamma_costs import SweptGamma, GammaFullCovariance, GammaStocksTransactionCost
 
 # u, t, shares_traded
 type TradeResult = tuple[pd.Series, pd.Timestamp, pd.Series]
@@ -16,6 +21,27 @@ type TradeResult = tuple[pd.Series, pd.Timestamp, pd.Series]
 # expected return, expected risk
 type PortfolioPerformance = tuple[float, float]
 
+# policy, gamma_risk, gamma_trade
+type CompiledPolicy = tuple[cvx.policies.Policy, SweptGamma, SweptGamma]
+
+POLICY_CACHE_SIZE = 8
+DEFAULT_PLANNING_HORIZON = 6
+# Compile and solve time grow with the horizon, and each distinct value is its own cached policy
+MAX_PLANNING_HORIZON = 20
+
+
+def _weights(h: np.ndarray | pd.Series) -> np.ndarray:
+    """
+    Converts holdings to weights by gross value
+    Works on a float64 view of h, so the division allocates the only new array
+
+    :param h: Holdings of one portfolio, or of many portfolios with one per row
+
+    :return: Weights with the same shape as h
+    """
+    h = np.asarray(h, dtype=np.float64)
+    return h / np.sum(np.abs(h), axis=-1, keepdims=True)
+
 
 class OptimizationEngine:
     __id: str
@@ -23,6 +49,7 @@ class OptimizationEngine:
     tickers: list[str]
     t: pd.Timestamp
     risk_free_rate: float
+    __lock: threading.Lock  # Compiled policies keep solver state, so they run one at a time
 
     def __init__(self, tickers: list[str]):
         # TODO get return forecasts from clickhouse and pass into r_forecast
@@ -30,6 +57,9 @@ class OptimizationEngine:
         self.data = DataProvider(tickers)
         self.t = self.data.trading_calendar()[-1]  # Current trading time
         self.risk_free_rate = 1.04 ** (1/252)  # TODO temp non-annualized risk free rate
+        self.__lock = threading.Lock()
+        # Later executions with the same constraints reuse the compiled policy
+        self._compiled_policy = functools.lru_cache(maxsize=POLICY_CACHE_SIZE)(self._compile_policy)
         self._genid()
         self._log(logger.info, "Successfully initalized {self.__id} with tickers {self.tickers}")
 
@@ -44,24 +74,29 @@ class OptimizationEngine:
         if addtl_fields is None:
             addtl_fields = {}
 
-        if APP_ENV == "production":
-            severity(json.dumps({
-                "class_instance": self.__id,
-                "data_instance": self.data.__id,
-                "tickers": self.tickers,
-                "message": message,
-                **addtl_fields
-                }))
-        else:
+        def render() -> str:
+            if APP_ENV == "production":
+                return json.dumps({
+                    "class_instance": self.__id,
+                    "data_instance": self.data.__id,
+                    "tickers": self.tickers,
+                    "message": message,
+                    **addtl_fields
+                    })
             if addtl_fields == {}:
-                severity(message)
-            else:
-                severity(f"{message}\n{json.dumps(addtl_fields, indent=4)}")
+                return message
+            return f"{message}\n{json.dumps(addtl_fields, indent=4)}"
+
+        # Rendered only if the severity is enabled, since trace logs are on hot paths
+        getattr(logger.opt(lazy=True), severity.__name__)("{}", render)
 
     def _genid(self):
-        """Generates an 8-digit hash for the __id field of this OptimizationEngine. """
-        hashstr = str(self.tickers) + str(time.time())
-        self.__id = "OptimizationEngine" + str(abs(hash(hashstr)) % (10 ** 8))
+        """Generates an 8-digit hex hash for the __id field of this OptimizationEngine.
+        Unlike hash(), blake2b doesn't depend on the interpreter's hash seed.
+        """
+        digest = hashlib.blake2b(",".join(self.tickers).encode(), digest_size=4)
+        digest.update(struct.pack("<d", time.time()))
+        self.__id = "OptimizationEngine" + digest.hexdigest()
 
     def _default_r_forecast(self):
         """Produces a new returns forecaster instance.
@@ -75,36 +110,56 @@ class OptimizationEngine:
         """
         return cvx.forecast.HistoricalFactorizedCovariance()
 
-    def _make_policy(self, gamma_risk: float, gamma_trade: float,
-                     constraints: list[cvx.constraints.Constraint]) -> cvx.policies.Policy:
+    @functools.cached_property
+    def _mean_returns(self) -> pd.Series:
+        """Historical mean returns of the non-cash assets at current time, indexed by ticker.
+        Same values as self._default_r_forecast().estimate(self.data, self.t),
+        read from DataProvider's running sums since it serves returns with no missing values.
+        Computed on first use and shared by every later call, since self.t doesn't change.
+        """
+        return self.data.returns_mean_up_to(self.t).iloc[:-1]
+
+    @functools.cached_property
+    def _risk_factor(self) -> np.ndarray:
+        """Estimate of self._default_risk_metric() at current time.
+        It's a square root factor F of the covariance, so the covariance is F @ F.T.
+        Computed on first use and shared by every later call, since self.t doesn't change.
+        """
+        return np.asarray(self._default_risk_metric().estimate(self.data, self.t))
+
+    def _make_policy(self, gamma_risk: SweptGamma, gamma_trade: SweptGamma,
+                     constraints: list[cvx.constraints.Constraint],
+                     planning_horizon: int = DEFAULT_PLANNING_HORIZON) -> cvx.policies.Policy:
         """Creates an optimization policy from the provided hyperparameters.
+        The hyperparameters can be changed after the policy is compiled.
 
         :param gamma_risk: Risk aversion hyperparameter
         :param gamma_trade: Trade aversion hyperparameter
         :param constraints: Extra constraints for the optimizer
+
+        Optional
+        :param planning_horizon: Number of trading periods the policy plans over
         """
         self._log(logger.trace, f"{self.__id} Created new MPO policy", {
-            "gamma_risk": gamma_risk,
-            "gamma_trade": gamma_trade,
             "constraints": str(constraints),
             "r_forecaster": str(self._default_r_forecast())
             })
         return cvx.MultiPeriodOptimization(
             cvx.ReturnsForecast(self._default_r_forecast())
-            - gamma_risk * cvx.FullCovariance(self._default_risk_metric())
-            - gamma_trade * cvx.StocksTransactionCost(),
+            - GammaFullCovariance(gamma_risk, self._default_risk_metric())
+            - GammaStocksTransactionCost(gamma_trade),
             [cvx.LongOnly(), cvx.LeverageLimit(1), *constraints],
-            planning_horizon=6,
-            solver="ECOS",
+            planning_horizon=planning_horizon,
+            solver="CLARABEL",
         )
 
     def _cash_only(self) -> pd.Series:
         """Creates $1M cash only portfolios.
         A series of all 0s except at the USDOLLAR entry in the final position.
         """
-        portfolio = pd.Series([0 for _ in self.data.tickers] + [1_000_000])
-        portfolio.index = np.append(self.data.tickers, "USDOLLAR")
-        return portfolio
+        portfolio = np.zeros(len(self.data.tickers) + 1, dtype=np.float64)
+        portfolio[-1] = 1_000_000
+        return pd.Series(portfolio, index=self.data.tickers_with_cash, copy=False)
 
     def h_return(self, h: pd.Series) -> float:
         """Calculates expected return for a portfolio produced by self.execute().
@@ -114,11 +169,11 @@ class OptimizationEngine:
 
         :return: Expected return at current time
         """
-        w = h / np.sum(np.abs(h))  # Portfolio by asset weight
-        exp_returns = self._default_r_forecast().estimate(self.data, self.t)
+        w = _weights(h)  # Portfolio by asset weight
+        exp_returns = self._mean_returns.to_numpy()
         # Include risk-free rate for cash position
         # exp_returns["USDOLLAR"] = self.risk_free_rate
-        return 1 + sum(map(lambda a, b: a * b, exp_returns, w))
+        return 1 + float(exp_returns @ w[:len(exp_returns)])
 
     def h_risk(self, h: pd.Series) -> float:
         """Calculates expected risk for a portfolio produced by self.execute().
@@ -128,13 +183,75 @@ class OptimizationEngine:
 
         :return: Expected risk at current time
         """
-        w = h / np.sum(np.abs(h))  # Portfolio by asset weight
-        risk_mat = self._default_risk_metric().estimate(self.data, self.t)
-        return w.T @ risk_mat @ w
+        w = _weights(h)  # Portfolio by asset weight
+        # w.T @ F @ F.T @ w, without forming the covariance
+        Ftw = self._risk_factor.T @ w
+        return float(Ftw @ Ftw)
+
+    def h_return_batch(self, H: np.ndarray) -> np.ndarray:
+        """Calculates expected returns for many portfolios at once, as self.h_return() does for one.
+
+        :param H: Portfolios to calculate returns for, one per row
+                  Columns ordered as self.data.tickers followed by the cash position
+                  Cash position ignored
+
+        :return: Expected return of each portfolio at current time
+        """
+        W = _weights(H)  # Portfolios by asset weight
+        return 1 + W[:, :-1] @ self._mean_returns.to_numpy()
+
+    def h_risk_batch(self, H: np.ndarray) -> np.ndarray:
+        """Calculates expected risks for many portfolios at once, as self.h_risk() does for one.
+        The risk estimate is shared by every portfolio.
+
+        :param H: Portfolios to calculate risk for, one per row
+                  Columns ordered as self.data.tickers
+                  Must not contain the cash position
+
+        :return: Expected risk of each portfolio at current time
+        """
+        W = _weights(H)  # Portfolios by asset weight
+        # Squared norm of each row of W @ F, as in self.h_risk()
+        WF = W @ self._risk_factor
+        return np.einsum("ij,ij->i", WF, WF)
+
+    def _compile_policy(self, t: pd.Timestamp, r_target: None | float,
+                        sig_thresh: None | float, planning_horizon: int) -> CompiledPolicy:
+        """Creates and compiles a policy for execution at time t.
+        Use self._compiled_policy() instead, which reuses policies compiled for earlier executions.
+
+        :param t: Time of execution
+        :param r_target: Returns target value
+        :param sig_thresh: Risk threshold value
+        :param planning_horizon: Number of trading periods the policy plans over
+
+        :return: Compiled policy, and the gammas to set before each solve
+        """
+        addtl_constraints = []
+
+        if r_target is not None:  # Append returns target constraint if r_target exists
+            rhat = self._mean_returns
+            addtl_constraints.append(ReturnsTarget(rhat, r_target))
+        if sig_thresh is not None:  # Append risk threshold constraint if sig_thresh exists
+            sigma = self._risk_factor @ self._risk_factor.T
+            addtl_constraints.append(RiskThreshold(sigma, sig_thresh))
+
+        gamma_risk, gamma_trade = SweptGamma(), SweptGamma()
+        policy = self._make_policy(gamma_risk, gamma_trade, addtl_constraints, planning_horizon)
+
+        # Same steps as policy.execute(), except the problem is compiled once
+        # and only its parameter values change for each solve
+        trading_calendar = self.data.trading_calendar()
+        past_returns = self.data.serve(t)[0]
+        policy.initialize_estimator_recursive(
+            universe=past_returns.columns,
+            trading_calendar=trading_calendar[trading_calendar >= t])
+        return policy, gamma_risk, gamma_trade
 
     def execute(self, h: pd.Series, t: pd.Timestamp = None, *args,
                 r_target: None | float = None,
-                sig_thresh: None | float = None) -> list[TradeResult]:
+                sig_thresh: None | float = None,
+                planning_horizon: int = DEFAULT_PLANNING_HORIZON) -> list[TradeResult]:
         """Executes all trading policies at current or user specified time.
 
         :param h: Holdings vector, in dollars, including the cash account (the last element).
@@ -144,19 +261,38 @@ class OptimizationEngine:
         :param r_target: Returns target value
         :param sig_thresh: Risk threshold value
                            SHOULD NOT BE USED! RISK THRESHOLD DOESN'T WORK
+        :param planning_horizon: Number of trading periods the policies plan over
+                                 Shorter horizons solve faster, 1 plans only the next trade
+                                 Must be between 1 and MAX_PLANNING_HORIZON
 
         :return: List of trade weights, trade timestamps, and shares traded
         """
-        addtl_constraints = []
-
         if t is None:
             t = self.t
-        if r_target is not None:  # Append returns target constraint if r_target exists
-            rhat = self._default_r_forecast().estimate(self.data, self.t)
-            addtl_constraints.append(ReturnsTarget(rhat, r_target))
-        if sig_thresh is not None:  # Append risk threshold constraint if sig_thresh exists
-            sigma = self._default_risk_metric().estimate(self.data, self.t)
-            addtl_constraints.append(RiskThreshold(sigma, sig_thresh))
+
+        if not 1 <= planning_horizon <= MAX_PLANNING_HORIZON:
+            raise ValueError(f"Planning horizon must be between 1 and {MAX_PLANNING_HORIZON}, "
+                             f"got {planning_horizon}.")
+
+        # Same input checks as cvx.policies.Policy.execute(), which this method replaces
+        if t not in self.data.trading_calendar():
+            raise cvx.errors.UserDataError(
+                f"Provided time {t} must be in the trading calendar implied by the market data "
+                "server.")
+        if np.any(h.isnull()):
+            raise cvx.errors.UserDataError(
+                "Holdings provided to OptimizationEngine.execute have missing values!")
+        v = np.sum(h)
+        if v < 0.:
+            raise cvx.errors.UserDataError(
+                "Holdings provided to OptimizationEngine.execute have negative sum.")
+
+        past_returns, _, past_volumes, _, current_prices = self.data.serve(t)
+        if sorted(h.index) != sorted(past_returns.columns):
+            raise cvx.errors.UserDataError(
+                "Holdings provided don't match the universe implied by the market data server.")
+        h = h[past_returns.columns]
+        w = h / v
 
         risk_gammas = [5, 10, 20, 50, 100, 200, 500]
         trade_gammas = [0.5, 0.75, 1, 1.25, 1.5, 2, 2.5, 3, 4, 5]
@@ -164,11 +300,20 @@ class OptimizationEngine:
             "risk_gammas": risk_gammas,
             "trade_gammas": trade_gammas
             })
-        policies = [
-            self._make_policy(gr, gt, addtl_constraints)
-            for gr in risk_gammas for gt in trade_gammas
-        ]
 
-        res = list(map(lambda p: p.execute(h, self.data, t), policies))
+        res = []
+        with self.__lock:
+            policy, gamma_risk, gamma_trade = self._compiled_policy(
+                t, r_target, sig_thresh, planning_horizon)
+            for gr in risk_gammas:
+                for gt in trade_gammas:
+                    gamma_risk.value, gamma_trade.value = gr, gt
+                    w_plus = policy.values_in_time_recursive(
+                        t=t, past_returns=past_returns, past_volumes=past_volumes,
+                        current_weights=w, current_portfolio_value=v,
+                        current_prices=current_prices)
+                    u = (w_plus - w) * v
+                    shares_traded = pd.Series(np.round(u.iloc[:-1] / current_prices), dtype=int)
+                    res.append((u, t, shares_traded))
         self._log(logger.success, f"{self.__id} MPO execution succeeded")
         return res
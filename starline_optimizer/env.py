@@ -3,6 +3,7 @@ import os
 import pandas as pd
 
 from clickhouse_connect import get_client, common
+from clickhouse_connect.driver import httputil
 
 __REQUIRED_ENV_VARS = [
     "APP_ENV",
@@ -28,7 +29,12 @@ DB_SETTINGS = {
 # This should always be set before creating a client
 common.set_setting("autogenerate_session_id", False)
 
-client = get_client(**DB_SETTINGS)
+# Connections kept alive for reuse by the shared client
+# Queries issued concurrently beyond this open throwaway connections
+CLICKHOUSE_POOL_SIZE = 16
+
+client = get_client(**DB_SETTINGS,
+                    pool_mgr=httputil.get_pool_manager(maxsize=CLICKHOUSE_POOL_SIZE))
 
 # Omit all database entries before 1/1/2000
 OLDEST_ENTRY_DATE = pd.Timestamp(year=2000, month=1, day=1)
@@ -0,0 +1,73 @@
+import copy
+import cvxportfolio as cvx
+import numpy as np
+
+
+class SweptGamma(cvx.hyperparameters.HyperParameter):
+    def __init__(self, value: float = 1.):
+        """Cost multiplier that can be changed between solves of an already compiled policy.
+        cvxportfolio resolves its own hyperparameters into constants when compiling,
+        so changing one of those means compiling the whole problem again.
+
+        :param value: Initial multiplier value
+        """
+        self.value = value
+
+    @property
+    def current_value(self) -> float:
+        return self.value
+
+
+class _SweptGammaCost:
+    """Shares a cost's SweptGamma between the copies made for each step of an MPO policy."""
+    gamma: SweptGamma
+
+    def copy_keeping_multipliers(self):
+        return copy.deepcopy(self, {id(self.gamma): self.gamma})
+
+
+class GammaFullCovariance(_SweptGammaCost, cvx.FullCovariance):
+    def __init__(self, gamma: SweptGamma, Sigma=cvx.forecast.HistoricalFactorizedCovariance):
+        """Full covariance risk term multiplied by gamma.
+        The multiplier is folded into the covariance factor's parameter value, so the
+        compiled problem stays DPP and changing gamma doesn't recompile it.
+
+        :param gamma: Risk aversion hyperparameter
+        :param Sigma: Covariance forecaster, same as cvx.FullCovariance
+        """
+        super().__init__(Sigma)
+        self.gamma = gamma
+
+    def __repr__(self):
+        return f"{self.gamma} * {super().__repr__()}"
+
+    def values_in_time(self, **kwargs):
+        super().values_in_time(**kwargs)
+        # Risk is quadratic in the factor
+        self._sigma_sqrt.value = np.sqrt(self.gamma.current_value) * self._sigma_sqrt.value
+
+
+class GammaStocksTransactionCost(_SweptGammaCost, cvx.StocksTransactionCost):
+    def __init__(self, gamma: SweptGamma, **kwargs):
+        """Stocks transaction cost term multiplied by gamma.
+        The multiplier is folded into the cost's parameter values, so the
+        compiled problem stays DPP and changing gamma doesn't recompile it.
+
+        :param gamma: Trade aversion hyperparameter
+        :param kwargs: Same as cvx.StocksTransactionCost
+        """
+        super().__init__(**kwargs)
+        self.gamma = gamma
+
+    def __repr__(self):
+        return f"{self.gamma} * {super().__repr__()}"
+
+    def values_in_time(self, **kwargs):
+        super().values_in_time(**kwargs)
+        # Cost is linear in both multipliers
+        if self._first_term_multiplier is not None:
+            self._first_term_multiplier.value = \
+                self.gamma.current_value * self._first_term_multiplier.value
+        if self._second_term_multiplier is not None:
+            self._second_term_multiplier.value = \
+                self.gamma.current_value * self._second_term_multiplier.value
@@ -14,8 +14,10 @@ class ReturnsTarget(cvx.constraints.Constraint):
         :param rhat: Expected returns for next trading period
         :param lim: Annualized portfolio returns target value
         """
-        self.rhat = rhat
+        # Converted once here, since each planning step of an MPO policy compiles its own copy
+        self.rhat = np.asarray(rhat, dtype=np.float64)
         self.lim = lim
+        self.daily_lim = (lim ** (1 / 252)) - 1  # De-annualize returns target
         return
 
     def __str__(self):
@@ -33,11 +35,8 @@ class ReturnsTarget(cvx.constraints.Constraint):
         :param w_plus: Post-trade weights.
         :param z: Trade weights.
         """
-        lim_param = cp.Parameter()
-        lim_param.value = (self.lim ** (1 / 252)) - 1  # De-annualize returns target
-
-        exp_rhat = cp.Parameter(len(self.rhat))
-        exp_rhat.value = np.array(self.rhat)
+        lim_param = cp.Parameter(value=self.daily_lim)
+        exp_rhat = cp.Parameter(len(self.rhat), value=self.rhat)
         return exp_rhat.T @ w_plus[:-1] >= lim_param
 
 